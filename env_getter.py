@@ -1,6 +1,30 @@
-import platform, subprocess
+import json
+import platform
+import sys
+from importlib.metadata import distributions
+
+# pip freeze leaves out its own tooling
+SKIP = {"pip"} if sys.version_info >= (3, 12) else {"pip", "setuptools", "wheel", "distribute"}
+
+def requirement(dist):
+    name = dist.metadata["Name"]
+    direct = dist.read_text("direct_url.json")
+    if not direct:
+        return f"{name}=={dist.version}"
+
+    info = json.loads(direct)
+    url = info["url"]
+    if "vcs_info" in info:
+        vcs = info["vcs_info"]
+        url = f"{vcs['vcs']}+{url}@{vcs['commit_id']}"
+    if info.get("dir_info", {}).get("editable"):
+        return f"-e {url}"
+    return f"{name} @ {url}"
 
 with open("requirements.txt", "w") as f:
     f.write(f"# Python {platform.python_version()} ({platform.architecture()[0]})\n")
-    freeze_output = subprocess.run(["pip", "freeze"], capture_output=True, text=True)
-    f.write(freeze_output.stdout)
+    lines = sorted(
+        {requirement(d) for d in distributions() if d.metadata["Name"].lower() not in SKIP},
+        key=str.lower
+    )
+    f.write("\n".join(lines) + "\n")
@@ -1,244 +1,445 @@
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
+import asyncio
+import atexit
+import contextvars
 import ctypes
-from ctypes import (
-    c_int, c_ubyte, c_char_p,
-    POINTER, create_string_buffer
-)
-import threading
+import functools
+import itertools
+from ctypes import c_ubyte, create_string_buffer
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 import uvicorn
+from pydantic import BaseModel, Field
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError, PyMongoError
 from mongodb import connect_to_database
+from sdk import load_sdk
 
 # -----------------------------------------------------
 # 1️⃣ App & Logging
 # -----------------------------------------------------
-app = FastAPI(title="ProRFL SDK Agent")
-
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-)
-
-sdk_lock = threading.Lock()
+app = FastAPI(title="ProRFL SDK Agent", default_response_class=ORJSONResponse)
+
+# Set once per request by the middleware below and stamped on every log
+# record by RequestIdFilter, so log calls don't format the id themselves.
+# It is kept as an int and only formatted when a record is written;
+# 0 marks records emitted outside a request.
+req_id_var = contextvars.ContextVar("req_id", default=0)
+_req_ids = itertools.count(1)
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.req_id = req_id_var.get()
+        return True
+
+# Handlers write from the listener thread; request code only enqueues records
+_log_format = logging.Formatter("%(asctime)s [%(levelname)s] REQ-%(req_id)s: %(message)s")
+_log_queue = queue.Queue(-1)
+_log_handlers = [logging.FileHandler("sdk_agent.log"), logging.StreamHandler()]
+for _h in _log_handlers:
+    _h.setFormatter(_log_format)
+
+log_listener = QueueListener(_log_queue, *_log_handlers)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# The filter sits on the QueueHandler because it must run in the request's
+# context, not on the listener thread.
+_queue_handler = QueueHandler(_log_queue)
+_queue_handler.addFilter(RequestIdFilter())
+logging.getLogger().addHandler(_queue_handler)
+logging.getLogger().setLevel(logging.INFO)
+
+# Plain ASGI rather than @app.middleware("http"), which wraps every request
+# in BaseHTTPMiddleware's task group and body streaming.
+class RequestIdMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            req_id_var.set(next(_req_ids))
+        await self.app(scope, receive, send)
+
+app.add_middleware(RequestIdMiddleware)
+
+sdk_lock = asyncio.Lock()
+# Every SDK call runs on this one thread, so the DLL never sees two callers
+# and the USB handle opened at startup never crosses threads.
+sdk_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sdk")
 
 # -----------------------------------------------------
 # 2️⃣ Database
 # -----------------------------------------------------
-db = connect_to_database()["keycard_db"]
-cards = db["cards"]
+# Bound by connect_db on startup, so importing the app never waits on Mongo
+db = None
+cards = None
+
+# Card records are queued by /create_card and written in batches of up to
+# CARD_WRITE_BATCH docs, collected over at most CARD_WRITE_WINDOW seconds.
+CARD_WRITE_BATCH = 500
+CARD_WRITE_WINDOW = 0.05
+# A batch that cannot reach Mongo is retried with a linear backoff before
+# its records are logged as dropped.
+CARD_WRITE_RETRIES = 3
+CARD_WRITE_BACKOFF = 0.5
+
+card_writes = asyncio.Queue()
+card_writer = None
+
+# /stats serves a cached collection count for up to STATS_TTL seconds.
+STATS_TTL = 2.0
+_count_cache = (0.0, 0)
+
+def log_dropped_cards(docs, reason):
+    # The card is already encoded by now, so this log is the only record
+    # left for reconciling it with Mongo by hand.
+    for doc in docs:
+        logging.error(
+            "Card record not stored (%s): hotel_id=%s card_no=%s card_hex=%s",
+            reason, doc.get("hotel_id"), doc.get("card_no"), doc.get("card_hex")
+        )
+
+async def write_cards(batch):
+    ops = [InsertOne(doc) for doc in batch]
+    for attempt in range(1, CARD_WRITE_RETRIES + 1):
+        try:
+            await cards.bulk_write(ops, ordered=False)
+            return
+        except BulkWriteError as e:
+            # Per-document failures will not succeed on a retry. InsertOne
+            # sets _id on the doc, so after a retry a duplicate key means the
+            # earlier attempt already stored it.
+            failed = [
+                batch[err["index"]]
+                for err in e.details.get("writeErrors", [])
+                if not (attempt > 1 and err.get("code") == 11000)
+            ]
+            log_dropped_cards(failed, "write error")
+            return
+        except PyMongoError as e:
+            logging.warning(
+                "Card write attempt %d/%d failed for %d records: %s",
+                attempt, CARD_WRITE_RETRIES, len(batch), e
+            )
+            if attempt < CARD_WRITE_RETRIES:
+                await asyncio.sleep(CARD_WRITE_BACKOFF * attempt)
+
+    log_dropped_cards(batch, "Mongo unavailable")
+
+async def flush_card_writes():
+    while True:
+        batch = [await card_writes.get()]
+        deadline = time.monotonic() + CARD_WRITE_WINDOW
+
+        while len(batch) < CARD_WRITE_BATCH:
+            if not card_writes.empty():
+                batch.append(card_writes.get_nowait())
+                continue
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(card_writes.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Nothing may escape here: a dead writer would leave the queue growing
+        # and stop_card_writer waiting on it forever.
+        try:
+            await write_cards(batch)
+        except Exception:
+            logging.exception("Card writer failed on a batch of %d", len(batch))
+            log_dropped_cards(batch, "writer error")
+        finally:
+            for _ in batch:
+                card_writes.task_done()
 
 # -----------------------------------------------------
 # 3️⃣ Load DLL
 # -----------------------------------------------------
-sdk = ctypes.WinDLL(r"C:\Users\chinedu.orjiogo\Documents\Rolak_keycard\proRFL.dll")
-
-# -----------------------------------------------------
-# 4️⃣ SDK Function Mapping
-# -----------------------------------------------------
-sdk.initializeUSB.argtypes = [c_ubyte]
-sdk.initializeUSB.restype = c_int
-
-sdk.CloseUSB.argtypes = [c_ubyte]
-
-sdk.Buzzer.argtypes = [c_ubyte, c_ubyte]
-sdk.Buzzer.restype = c_int
-
-sdk.GuestCard.argtypes = [
-    c_ubyte, c_int, c_ubyte, c_ubyte,
-    c_ubyte, c_ubyte,
-    c_char_p, c_char_p,
-    POINTER(c_ubyte),
-    c_char_p
-]
-sdk.GuestCard.restype = c_int
-
-sdk.ReadCard.argtypes = [c_ubyte, c_char_p]
-sdk.ReadCard.restype = c_int
-
-sdk.CardErase.argtypes = [c_ubyte, c_int, c_char_p]
-sdk.CardErase.restype = c_int
-
-sdk.ReadRecord.argtypes = [c_ubyte, POINTER(c_ubyte)]
-sdk.ReadRecord.restype = c_int
-
-sdk.GetOpenRecordByDataStr.argtypes = [POINTER(c_ubyte), POINTER(c_ubyte)]
-sdk.GetOpenRecordByDataStr.restype = c_int
+sdk = load_sdk()
+
+# Bound once so the wrappers below skip the attribute lookup on sdk
+_sdk_initializeUSB = sdk.initializeUSB
+_sdk_CloseUSB = sdk.CloseUSB
+_sdk_Buzzer = sdk.Buzzer
+_sdk_GuestCard = sdk.GuestCard
+_sdk_ReadCard = sdk.ReadCard
+_sdk_CardErase = sdk.CardErase
+_sdk_ReadRecord = sdk.ReadRecord
+_sdk_GetOpenRecordByDataStr = sdk.GetOpenRecordByDataStr
+
+# Fixed arguments prebuilt as c_ubyte so ctypes passes them without converting
+_USB = c_ubyte(1)  # encoder selector used by every call
+_ONE = c_ubyte(1)
 
 # -----------------------------------------------------
-# 5️⃣ Helpers
+# 4️⃣ Helpers
 # -----------------------------------------------------
+# Only changed while sdk_lock is held; /stats reads it without the lock.
 TOTAL_ROOMS = 16
 
 def init_usb():
-    return sdk.initializeUSB(1) == 0
+    return _sdk_initializeUSB(_USB) == 0
 
 def close_usb():
-    sdk.CloseUSB(1)
+    _sdk_CloseUSB(_USB)
 
 def buzzer(ms=300):
-    sdk.Buzzer(1, ms // 10)
+    _sdk_Buzzer(_USB, ms // 10)
 
 def lockstr_to_bytes(lockstr: str):
     if len(lockstr) != 8:
         raise ValueError("LockNo must be exactly 8 chars")
-    return (c_ubyte * 8)(*[ord(c) for c in lockstr])
+    buf = (c_ubyte * 8)()
+    ctypes.memmove(buf, lockstr.encode("ascii"), 8)
+    return buf
+
+_MONTHS = {
+    "Jan":"01","Feb":"02","Mar":"03","Apr":"04",
+    "May":"05","Jun":"06","Jul":"07","Aug":"08",
+    "Sep":"09","Oct":"10","Nov":"11","Dec":"12"
+}
 
 def convert_date(d):
-    day, mon, year = d.split("-")
-    months = {
-        "Jan":"01","Feb":"02","Mar":"03","Apr":"04",
-        "May":"05","Jun":"06","Jul":"07","Aug":"08",
-        "Sep":"09","Oct":"10","Nov":"11","Dec":"12"
-    }
-    return f"{year[-2:]}{months[mon]}{day.zfill(2)}0000"
+    day, mon, year = d.split("-", 2)
+    return f"{year[-2:]}{_MONTHS[mon]}{day.zfill(2)}0000"
+
+def card_hex_str(data):
+    # The single codec for card bytes: the card_hex stored at creation and the
+    # /delete_card lookup key must decode identically or the record is lost.
+    return data.decode("ascii", errors="ignore")
+
+@functools.lru_cache(maxsize=4096)
+def convert_date_bytes(d):
+    # Guests often share check-in/out dates, so the encoded SDK form is cached
+    return convert_date(d).encode("ascii")
 
 # -----------------------------------------------------
-# 6️⃣ Core SDK Operations
+# 5️⃣ Core SDK Operations
 # -----------------------------------------------------
+# Output buffers are reused across calls; sdk_lock guarantees a single
+# caller, and each one is zeroed before the SDK writes into it.
+_CARD_BUF = create_string_buffer(200)
+_DOORS_BUF = (c_ubyte * 64)()
+_OPEN_BUF = (c_ubyte * 32)()
+
 def create_card(hotel_id, card_no, bdate, edate, lock_bytes):
     dai = 0  # 🔧 SAFETY GUARD: NEVER CHANGE
-    buf = create_string_buffer(200)
+    ctypes.memset(_CARD_BUF, 0, 200)
 
-    res = sdk.GuestCard(
-        1, hotel_id, card_no,
-        dai, 1, 1,
-        bdate.encode(),
-        edate.encode(),
+    res = _sdk_GuestCard(
+        _USB, hotel_id, card_no,
+        dai, _ONE, _ONE,
+        bdate,
+        edate,
         lock_bytes,
-        buf
+        _CARD_BUF
     )
-    return res, buf.value.decode(errors="ignore").rstrip("\x00")
+    return res, card_hex_str(_CARD_BUF.value)
 
 def read_card():
-    buf = create_string_buffer(200)
-    res = sdk.ReadCard(1, buf)
-    return res, buf.value
+    ctypes.memset(_CARD_BUF, 0, 200)
+    res = _sdk_ReadCard(_USB, _CARD_BUF)
+    return res, _CARD_BUF.value
 
-def erase_card(hotel_id, card_hex):
-    return sdk.CardErase(1, hotel_id, card_hex.encode())
+def erase_card(hotel_id, card_data):
+    return _sdk_CardErase(_USB, hotel_id, card_data)
 
 def get_opened_doors():
-    doors = (c_ubyte * 64)()
-    res = sdk.ReadRecord(1, doors)
-    return res, list(doors)
+    ctypes.memset(_DOORS_BUF, 0, 64)
+    res = _sdk_ReadRecord(_USB, _DOORS_BUF)
+    return res, ctypes.string_at(_DOORS_BUF, 64)
 
 def decode_open_record(card_data):
-    data = (c_ubyte * len(card_data))(*card_data)
-    out = (c_ubyte * 32)()
-    res = sdk.GetOpenRecordByDataStr(data, out)
-    return res, list(out)
+    data = (c_ubyte * len(card_data)).from_buffer_copy(card_data)
+    ctypes.memset(_OPEN_BUF, 0, 32)
+    res = _sdk_GetOpenRecordByDataStr(data, _OPEN_BUF)
+    return res, ctypes.string_at(_OPEN_BUF, 32)
+
+def issue_card(hotel_id, card_no, bdate, edate, lock_bytes):
+    global TOTAL_ROOMS
+    if TOTAL_ROOMS <= 0:
+        raise HTTPException(500, "No rooms available")
+    
+    res, hexdata = create_card(
+        hotel_id,
+        card_no,
+        bdate, edate,
+        lock_bytes
+    )
+    buzzer()
+
+    if res != 0:
+        raise HTTPException(500, f"SDK error {res}")
+    
+    TOTAL_ROOMS -= 1  # 🔧 SAFETY GUARD: NEVER REMOVE
+
+    return hexdata
+
+def wipe_card(hotel_id, card_data):
+    res = erase_card(hotel_id, card_data)
+    buzzer()
+    return res
+
+def reset_usb():
+    close_usb()
+    return init_usb()
+
+def inspect_card():
+    # The SDK is not re-entrant and these calls share one USB channel and
+    # the module buffers, so they run back to back rather than concurrently.
+    res, raw = read_card()
+    if res != 0:
+        raise HTTPException(500, "Read failed")
+
+    doors_res, doors = get_opened_doors()
+    rec_res, record = decode_open_record(raw) if raw else (-1, None)
+
+    return {
+        "card_data": card_hex_str(raw),
+        "opened_doors": list(doors) if doors_res == 0 else None,
+        "open_record": list(record) if rec_res == 0 else None
+    }
+
+# sdk_executor's single thread is the only one that touches the DLL, and
+# each job bundles every SDK call a step needs so it costs one hop to it.
+# Every endpoint still takes sdk_lock, through sdk_session, so that a
+# multi-job sequence (the read, lookup and erase in /delete_card) cannot
+# interleave with others.
+def run_sdk(fn, *args):
+    return asyncio.get_running_loop().run_in_executor(sdk_executor, fn, *args)
+
+@asynccontextmanager
+async def sdk_session():
+    queued = time.perf_counter()
+    async with sdk_lock:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            logging.debug(
+                "SDK session waited %.3fs, ran %.3fs",
+                started - queued, time.perf_counter() - started
+            )
 
 # -----------------------------------------------------
-# 7️⃣ API Endpoints
+# 6️⃣ API Endpoints
 # -----------------------------------------------------
+# SDK calls block, so they run on sdk_executor via run_sdk to keep the
+# event loop free for /health and /stats; Mongo I/O is awaited through
+# Motor. sdk_session awaits sdk_lock here, on the loop, so queued requests
+# wait without tying up a thread.
+# Bounds mirror the GuestCard argtypes, which truncate out-of-range ints
+# silently, and the formats lockstr_to_bytes and convert_date accept.
+# [0-9], not \d, which also matches non-ASCII digits the SDK cannot take
+_DATE_PATTERN = (
+    r"^(0?[1-9]|[12][0-9]|3[01])"
+    r"-(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)-[0-9]{4}$"
+)
+
+class CreateCardRequest(BaseModel):
+    hotel_id: int = Field(ge=0, le=2**31 - 1)  # c_int
+    card_no: int = Field(ge=0, le=255)  # c_ubyte
+    lock_no: str = Field(pattern=r"^[\x20-\x7e]{8}$")
+    checkin_time: str = Field(pattern=_DATE_PATTERN)
+    checkout_time: str = Field(pattern=_DATE_PATTERN)
+
 @app.post("/create_card")
-async def api_create(req: Request):
-    d = await req.json()
-    print(d)
+async def api_create(body: CreateCardRequest):
+    logging.debug("Create request: %s", body)
 
-    lock_bytes = lockstr_to_bytes(d["lock_no"])
-    bdate = convert_date(d["checkin_time"])
-    edate = convert_date(d["checkout_time"])
+    lock_bytes = lockstr_to_bytes(body.lock_no)
+    bdate = convert_date_bytes(body.checkin_time)
+    edate = convert_date_bytes(body.checkout_time)
 
-    print(f"Creating card for HotelID {d['hotel_id']}, CardNo {d['card_no']}, LockNo {d['lock_no']}, From {bdate} To {edate}")
+    # Refuse before encoding: a card whose record can never be stored would
+    # be impossible to delete later.
+    if card_writer is None or card_writer.done():
+        raise HTTPException(503, "Card writer is not running")
 
-    with sdk_lock:
-        if not init_usb():
-            raise HTTPException(500, "USB init failed")
+    logging.info(
+        "Creating card for HotelID %s, CardNo %s, LockNo %s, From %s To %s",
+        body.hotel_id, body.card_no, body.lock_no, body.checkin_time, body.checkout_time
+    )
 
-        try:
-            if TOTAL_ROOMS <= 0:
-                raise HTTPException(500, "No rooms available")
-            
-            res, hexdata = create_card(
-                int(d["hotel_id"]),
-                int(d["card_no"]),
-                bdate, edate,
-                lock_bytes
-            )
-            buzzer()
-
-            if res != 0:
-                raise HTTPException(500, f"SDK error {res}")
-            
-            TOTAL_ROOMS -= 1  # 🔧 SAFETY GUARD: NEVER REMOVE
-
-            cards.insert_one({
-                "hotel_id": d["hotel_id"],
-                "card_no": d["card_no"],
-                "lock_no": d["lock_no"],
-                "card_hex": hexdata,
-                "dai": 0,
-                "created_at": time.time()
-            })
-
-            return {"status": "success", "card_hex": hexdata}
-        finally:
-            close_usb()
+    async with sdk_session():
+        hexdata = await run_sdk(
+            issue_card,
+            body.hotel_id, body.card_no,
+            bdate, edate, lock_bytes
+        )
+
+    card_writes.put_nowait({
+        "hotel_id": body.hotel_id,
+        "card_no": body.card_no,
+        "lock_no": body.lock_no,
+        "card_hex": hexdata,
+        "dai": 0,
+        "created_at": time.time()
+    })
+
+    return {"status": "success", "card_hex": hexdata}
 
 @app.post("/inspect_card")
 async def api_inspect():
     """
     Reads card, opened doors, and decoded open records
     """
-    with sdk_lock:
-        if not init_usb():
-            raise HTTPException(500, "USB init failed")
-
-        try:
-            res, raw = read_card()
-            if res != 0:
-                raise HTTPException(500, "Read failed")
-
-            doors_res, doors = get_opened_doors()
-            rec_res, record = decode_open_record(raw)
-
-            return {
-                "card_data": raw.decode(errors="ignore"),
-                "opened_doors": doors if doors_res == 0 else None,
-                "open_record": record if rec_res == 0 else None
-            }
-        finally:
-            close_usb()
+    async with sdk_session():
+        return await run_sdk(inspect_card)
 
 @app.post("/delete_card")
 async def api_delete():
-    with sdk_lock:
-        if not init_usb():
-            raise HTTPException(500, "USB init failed")
+    global TOTAL_ROOMS
+    async with sdk_session():
+        res, raw = await run_sdk(read_card)
+        if res != 0 or not raw:
+            raise HTTPException(400, "Failed to read card")
+        card_hex = card_hex_str(raw)
 
-        try:
-            card_hex = read_card()
-            if not card_hex:
-                raise HTTPException(400, "Failed to read card")
-
-            rec = cards.find_one({"card_hex": card_hex})
-            if not rec:
-                raise HTTPException(404, "Card not found in database")
+        rec = await cards.find_one({"card_hex": card_hex})
+        if not rec:
+            raise HTTPException(404, "Card not found in database")
 
-            res = erase_card(rec["hotel_id"], card_hex)
-            buzzer()
+        res = await run_sdk(wipe_card, rec["hotel_id"], raw)
 
-            if res != 0:
-                raise HTTPException(500, "Erase failed")
+        if res != 0:
+            raise HTTPException(500, "Erase failed")
 
-            TOTAL_ROOMS += 1  # advisory counter
+        TOTAL_ROOMS += 1  # advisory counter
 
-            return {
-                "status": "success",
-                "card_no": rec["card_no"],
-                "lock_no": rec["lock_no"]
-            }
+        return {
+            "status": "success",
+            "card_no": rec["card_no"],
+            "lock_no": rec["lock_no"]
+        }
 
-        finally:
-            close_usb()
+@app.post("/reset_usb")
+async def api_reset_usb():
+    """
+    Re-opens the encoder after a hardware fault without restarting the agent
+    """
+    async with sdk_session():
+        if not await run_sdk(reset_usb):
+            raise HTTPException(500, "USB init failed")
 
+    return {"status": "success"}
 
 @app.get("/stats")
 async def api_stats():
-    total_cards = cards.count_documents({})
+    global _count_cache
+    ts, total_cards = _count_cache
+    now = time.monotonic()
+    if now - ts >= STATS_TTL:
+        total_cards = await cards.estimated_document_count()
+        _count_cache = (now, total_cards)
     return {
         "total_cards_issued": total_cards,
         "available_rooms": TOTAL_ROOMS
@@ -248,8 +449,52 @@ async def api_stats():
 async def health():
     return {"status": "ok"}
 
+@app.on_event("startup")
+async def connect_db():
+    global db, cards
+    db = connect_to_database()["keycard_db"]
+    cards = db["cards"]
+
+@app.on_event("startup")
+async def create_indexes():
+    # /delete_card looks cards up by the hex read back from the encoder
+    await cards.create_index("card_hex")
+
+@app.on_event("startup")
+async def start_card_writer():
+    global card_writer
+    card_writer = asyncio.create_task(flush_card_writes())
+
+@app.on_event("shutdown")
+async def stop_card_writer():
+    if card_writer.done():
+        pending = []
+        while not card_writes.empty():
+            pending.append(card_writes.get_nowait())
+        log_dropped_cards(pending, "writer stopped")
+        return
+    await card_writes.join()
+    card_writer.cancel()
+
+# The encoder is opened once for the life of the process rather than
+# around every request; sdk_lock still serializes the calls made on it.
+@app.on_event("startup")
+async def start_usb():
+    if not await run_sdk(init_usb):
+        raise RuntimeError("USB init failed")
+
+@app.on_event("shutdown")
+async def stop_usb():
+    async with sdk_session():
+        await run_sdk(close_usb)
+    sdk_executor.shutdown()
+
 # -----------------------------------------------------
-# 8️⃣ Run
+# 7️⃣ Run
 # -----------------------------------------------------
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=5000)
+    # "auto" picks uvloop and httptools when they can be imported and falls
+    # back to the asyncio loop and h11 otherwise; uvloop has no Windows build.
+    # One process only: each worker would open the encoder at startup and
+    # keep its own sdk_lock, TOTAL_ROOMS and card writer.
+    uvicorn.run(app, host="0.0.0.0", port=5000, loop="auto", http="auto")
@@ -1,5 +1,6 @@
 import os
-from pymongo import MongoClient
+import threading
+from motor.motor_asyncio import AsyncIOMotorClient
 
 from dotenv import load_dotenv
 
@@ -14,13 +15,23 @@ if not MONGODB_URI:
     )
 
 _cached_client = None
+_client_lock = threading.Lock()
 
 def connect_to_database():
     global _cached_client
     if _cached_client:
         return _cached_client
-    _cached_client = MongoClient(MONGODB_URI)
-    print("[OK] Connected to MongoDB")
+    with _client_lock:
+        if _cached_client is None:
+            # zlib is the fallback when zstandard or server support is missing
+            _cached_client = AsyncIOMotorClient(
+                MONGODB_URI,
+                appname="rolak-keycard",
+                serverSelectionTimeoutMS=2000,
+                maxPoolSize=10,
+                compressors="zstd,zlib"
+            )
+            print("[OK] Connected to MongoDB")
     return _cached_client
 
 # Usage:
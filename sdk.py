@@ -0,0 +1,45 @@
+import ctypes
+import functools
+from ctypes import c_int, c_ubyte, c_char_p, POINTER
+
+DLL_PATH = r"C:\Users\chinedu.orjiogo\Documents\Rolak_keycard\proRFL.dll"
+
+# -----------------------------------------------------
+# SDK Function Mapping
+# -----------------------------------------------------
+# Cached so every importer shares one WinDLL handle and one set of
+# prototypes, however many times the bindings are requested.
+@functools.cache
+def load_sdk():
+    sdk = ctypes.WinDLL(DLL_PATH)
+
+    sdk.initializeUSB.argtypes = [c_ubyte]
+    sdk.initializeUSB.restype = c_int
+
+    sdk.CloseUSB.argtypes = [c_ubyte]
+
+    sdk.Buzzer.argtypes = [c_ubyte, c_ubyte]
+    sdk.Buzzer.restype = c_int
+
+    sdk.GuestCard.argtypes = [
+        c_ubyte, c_int, c_ubyte, c_ubyte,
+        c_ubyte, c_ubyte,
+        c_char_p, c_char_p,
+        POINTER(c_ubyte),
+        c_char_p
+    ]
+    sdk.GuestCard.restype = c_int
+
+    sdk.ReadCard.argtypes = [c_ubyte, c_char_p]
+    sdk.ReadCard.restype = c_int
+
+    sdk.CardErase.argtypes = [c_ubyte, c_int, c_char_p]
+    sdk.CardErase.restype = c_int
+
+    sdk.ReadRecord.argtypes = [c_ubyte, POINTER(c_ubyte)]
+    sdk.ReadRecord.restype = c_int
+
+    sdk.GetOpenRecordByDataStr.argtypes = [POINTER(c_ubyte), POINTER(c_ubyte)]
+    sdk.GetOpenRecordByDataStr.restype = c_int
+
+    return sdk